@@ -0,0 +1,76 @@
+"""
+PDF rasterization with PyMuPDF, spread across worker processes.
+Lives outside streamlit_app.py so the worker function can be pickled by
+module name — functions defined in the Streamlit script cannot.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pymupdf
+
+# PyMuPDF holds the GIL while rendering, so pages only render in parallel in
+# separate processes. Only "fork" is usable: spawn/forkserver would re-run the
+# Streamlit script in every worker. Without it, pages render in-process.
+# The pool is forked from upload worker threads of an already multithreaded
+# server; Python 3.12+ warns that a lock held by another thread at fork time
+# can deadlock the child. That risk is accepted: workers only run PyMuPDF on
+# bytes they are handed and never touch logging, Streamlit or the network.
+_MP_CONTEXT = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+_MAX_WORKERS = min(os.cpu_count() or 1, 6)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Create the shared worker pool on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=_MAX_WORKERS, mp_context=_MP_CONTEXT)
+        return _pool
+
+
+def _discard_pool(pool):
+    """Drop a broken pool so the next call starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _render_pages(raw, page_numbers, dpi, jpg_quality):
+    """Render the given pages of a PDF to grayscale JPEG bytes.
+    Each worker opens its own copy of the document; PyMuPDF documents
+    can't be shared between processes."""
+    with pymupdf.open(stream=raw, filetype="pdf") as doc:
+        return [
+            doc.load_page(n).get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY).tobytes("jpeg", jpg_quality=jpg_quality)
+            for n in page_numbers
+        ]
+
+
+def rasterize_pdf(raw, dpi=300, jpg_quality=90):
+    """Rasterize every page of a PDF and return a list of JPEG bytes, one per page."""
+    with pymupdf.open(stream=raw, filetype="pdf") as doc:
+        page_count = doc.page_count
+    workers = min(page_count, _MAX_WORKERS)
+    if workers <= 1 or _MP_CONTEXT is None:
+        return _render_pages(raw, range(page_count), dpi, jpg_quality)
+    # One contiguous run of pages per worker, so the PDF bytes are sent to each worker once
+    step = -(-page_count // workers)
+    chunks = [range(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    # A dead worker (e.g. OOM-killed on a huge page) breaks the whole pool. Retry once on a
+    # fresh pool; never fall back to rendering here, in the server process shared by every session.
+    for _ in range(2):
+        pool = _get_pool()
+        try:
+            futures = [pool.submit(_render_pages, raw, chunk, dpi, jpg_quality) for chunk in chunks]
+            return [page for fut in futures for page in fut.result()]
+        except BrokenProcessPool:
+            _discard_pool(pool)
+    raise RuntimeError("PDF rendering worker crashed twice; the PDF may have pages too large to render at this resolution")
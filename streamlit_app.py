@@ -5,14 +5,23 @@ Upload scanned insurance payment checks (PDF or images) and get back a formatted
 import streamlit as st
 import anthropic
 import base64
-import json
+import hashlib
 import io
+import math
 import csv
+import os
 import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import orjson
 import openpyxl
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from pdf2image import convert_from_bytes
-from PIL import Image, ImageEnhance, ImageFilter
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+from PIL import Image, ImageFilter, ImageStat
+from pdf_render import rasterize_pdf
 
 # ─── Page config ───
 st.set_page_config(page_title="Check Parser", page_icon="🏦", layout="centered")
@@ -26,6 +35,19 @@ with st.sidebar:
         api_key = st.text_input("Anthropic API Key", type="password", help="Get yours at console.anthropic.com → API Keys")
     else:
         st.success("API key loaded from secrets")
+    max_workers = st.slider(
+        "Parallel requests", min_value=1, max_value=16, value=8,
+        help="Number of requests sent to Claude at the same time"
+    )
+    batch_size = st.slider(
+        "Checks per request", min_value=1, max_value=8, value=4,
+        help="Checks sent together in one request; lower this if results get mixed up"
+    )
+    image_quality = st.radio(
+        "Image quality", ["Standard", "High"], horizontal=True,
+        help="High sends larger, sharper images for hard-to-read checks (slower and costs more)"
+    )
+    max_side, jpeg_quality = (2048, 95) if image_quality == "High" else (1600, 85)
     st.markdown("---")
     st.caption("Check Parser v2.0")
     st.caption("Powered by Claude AI")
@@ -41,7 +63,7 @@ uploaded_files = st.file_uploader(
     help="You can upload a multi-page PDF or multiple image files"
 )
 
-EXTRACTION_PROMPT = """You are parsing a scanned insurance payment check image. Extract the data with extreme precision.
+EXTRACTION_PROMPT = """You are parsing scanned insurance payment check images, labeled "Check 1", "Check 2", and so on. Each image is a separate check. Extract the data from every check with extreme precision.
 
 IMPORTANT: Read every character carefully. Do NOT guess or approximate. If you cannot read a digit clearly, look at the MICR line (bottom of check) and the written amount line to cross-verify.
 
@@ -81,8 +103,20 @@ STEP-BY-STEP PROCESS:
 8. CLAIM: Look for "CLAIM NUMBER" or similar field.
    - If none exists, use empty string ""
 
-Return ONLY a valid JSON object with NO other text, NO markdown, NO explanation:
-{"Payer": "", "Date": "", "Amount": 0.00, "Bank": "", "Check_Number": "", "Account": "", "Routing": "", "Claim": ""}"""
+Return ONLY a valid JSON array with exactly one object per check image, in the same order as the images, with NO other text, NO markdown, NO explanation:
+[{"Payer": "", "Date": "", "Amount": 0.00, "Bank": "", "Check_Number": "", "Account": "", "Routing": "", "Claim": ""}]"""
+
+MODEL = "claude-sonnet-4-5-20250929"
+CACHE_DB = "check_cache.db"
+# Cached results are only valid for the model and prompt that produced them
+_CACHE_VERSION = hashlib.blake2b((MODEL + EXTRACTION_PROMPT).encode(), digest_size=8).hexdigest()
+
+# Response cleanup patterns, compiled once and shared by all parsing threads
+_FENCE_RE = re.compile(r'^\s*```[a-zA-Z]*\s*\n?|\n?```\s*$', re.MULTILINE)
+# A comma-separated array of flat objects (or nulls); anchored to that shape so brackets in surrounding
+# prose don't leak in, and with mandatory commas so unterminated arrays fail in linear time
+_JSON_ARRAY_RE = re.compile(r'\[\s*(?:\{[^{}]*\}|null)(?:\s*,\s*(?:\{[^{}]*\}|null))*\s*\]')
+_JSON_OBJ_RE = re.compile(r'\{[^{}]*\}', re.DOTALL)
 
 
 def auto_rotate_check(img):
@@ -97,143 +131,349 @@ def auto_rotate_check(img):
     return img
 
 
-def enhance_image(img):
-    """Enhance scanned check image for better OCR accuracy."""
-    # Auto-rotate to landscape first
+def crop_to_check(img, min_area=0.05, pad=10):
+    """Crop away the blank scanner margin around a check.
+    Everything darker than near-white counts as check content; if that
+    region is implausibly small (blank page, speckle), the original
+    image is returned unchanged."""
+    gray = np.asarray(img.convert("L"))
+    content = gray < 240
+    rows = np.flatnonzero(content.any(axis=1))
+    cols = np.flatnonzero(content.any(axis=0))
+    if rows.size == 0:
+        return img
+    top, bottom = max(rows[0] - pad, 0), min(rows[-1] + pad + 1, gray.shape[0])
+    left, right = max(cols[0] - pad, 0), min(cols[-1] + pad + 1, gray.shape[1])
+    if (bottom - top) * (right - left) < min_area * gray.size:
+        return img
+    return img.crop((left, top, right, bottom))
+
+
+def enhance_image(img, max_side=1600, sharpen=True):
+    """Enhance scanned check image for better OCR accuracy.
+    Pass sharpen=False to skip the contrast/sharpen pass for images
+    that are already crisp."""
+    # Drop scanner margins so the whole image budget goes to the check itself
+    img = crop_to_check(img)
+    # Auto-rotate to landscape
     img = auto_rotate_check(img)
-    # Convert to RGB if needed
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-    # Increase contrast
-    enhancer = ImageEnhance.Contrast(img)
-    img = enhancer.enhance(1.5)
-    # Sharpen
-    enhancer = ImageEnhance.Sharpness(img)
-    img = enhancer.enhance(2.0)
-    return img
-
-
-def image_to_base64(img):
-    """Convert a PIL image to base64-encoded PNG."""
-    img = enhance_image(img)
+    # Checks are near-monochrome — grayscale keeps the detail at a third of the pixel data
+    if img.mode != "L":
+        img = img.convert("L")
+    # Downscale — 300 DPI scans are far larger than Claude needs to read a check
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    if not sharpen:
+        return img
+    # Contrast 1.5x around mid-gray plus an unsharp mask, fused into one numpy pass:
+    # c(x) = 1.5 * (x - 128) + 128 is linear, so c(a) + (c(a) - c(blur)) = 1.5 * (2a - blur - 128) + 128
+    blur = np.asarray(img.filter(ImageFilter.GaussianBlur(1.2)), dtype=np.float32)
+    arr = np.asarray(img, dtype=np.float32)
+    arr *= 2.0
+    arr -= blur
+    arr -= 128.0
+    arr *= 1.5
+    arr += 128.0
+    np.clip(arr, 0, 255, out=arr)
+    return Image.fromarray(arr.astype(np.uint8))
+
+
+def content_hash(data):
+    """Short, stable fingerprint of image bytes, used as the parse cache key."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def encode_image(img, max_side=1600, quality=85, sharpen=True):
+    """Convert a PIL image to a (hash, JPEG bytes, media type) tuple."""
+    img = enhance_image(img, max_side, sharpen)
     buf = io.BytesIO()
-    img.save(buf, format="PNG", optimize=True)
-    return base64.standard_b64encode(buf.getvalue()).decode("utf-8")
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    data = buf.getvalue()
+    return content_hash(data), data, "image/jpeg"
 
 
-def bytes_to_base64(data, mime="image/png"):
-    """Convert raw bytes to base64, with enhancement for images."""
+def encode_bytes(data, mime="image/png", max_side=1600, quality=85):
+    """Prepare raw upload bytes for Claude, with enhancement for images."""
     try:
         img = Image.open(io.BytesIO(data))
-        return image_to_base64(img), "image/png"
+        # A landscape JPEG that already fits the size budget is sent as uploaded, without decoding it
+        if img.format == "JPEG" and img.mode in ("RGB", "L") and img.width >= img.height and max(img.size) <= max_side:
+            return content_hash(data), data, "image/jpeg"
+        # High-resolution, high-contrast photos don't benefit from the contrast/sharpen pass
+        crisp = min(img.size) >= 1200 and ImageStat.Stat(img.convert("L")).stddev[0] > 55
+        return encode_image(img, max_side, quality, sharpen=not crisp)
     except Exception:
-        return base64.standard_b64encode(data).decode("utf-8"), mime
+        return content_hash(data), data, mime
 
 
-def get_images_from_uploads(files):
-    """Convert uploaded files into a list of (base64_data, media_type) tuples."""
+def pdf_to_images(raw, max_side=1600, quality=85):
+    """Rasterize every page of a PDF and return a list of (hash, image_bytes, media_type) tuples."""
+    # Pages come back as compact JPEG bytes and are decoded one at a time
     images = []
+    for page_jpeg in rasterize_pdf(raw, dpi=300):
+        with Image.open(io.BytesIO(page_jpeg)) as page:
+            images.append(encode_image(page, max_side, quality))
+    return images
+
+
+def upload_to_images(raw, file_type, max_side=1600, quality=85):
+    """Convert one uploaded file into a list of (hash, image_bytes, media_type) tuples."""
+    if file_type == "application/pdf":
+        return pdf_to_images(raw, max_side, quality)
+    return [encode_bytes(raw, file_type if file_type else "image/jpeg", max_side, quality)]
+
+
+@st.cache_resource
+def _upload_pool():
+    """Shared worker pool that prepares uploads in the background."""
+    # PDF pages render in worker processes and PIL releases the GIL, so threads are enough to overlap files
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="upload")
+
+
+def submit_uploads(files, max_side=1600, quality=85):
+    """Start preparing uploaded files in the background and return one future per file.
+    Called as soon as files are uploaded, so pages are usually ready by the
+    time the user clicks Parse. Jobs are kept in the session keyed by file
+    content and image settings, so reruns and re-uploads reuse them."""
+    jobs = st.session_state.get("upload_jobs", {})
+    current = {}
+    futures = []
     for f in files:
-        raw = f.read()
-        if f.type == "application/pdf":
-            # Convert each PDF page to an image at HIGH resolution
-            pages = convert_from_bytes(raw, dpi=300)
-            for page in pages:
-                images.append((image_to_base64(page), "image/png"))
-        else:
-            b64, mime = bytes_to_base64(raw, f.type if f.type else "image/png")
-            images.append((b64, mime))
+        raw = f.getvalue()
+        key = (content_hash(raw), f.type, max_side, quality)
+        if key not in current:
+            job = jobs.get(key)
+            # Retry jobs that failed on an earlier run
+            if job is None or (job.done() and job.exception() is not None):
+                job = _upload_pool().submit(upload_to_images, raw, f.type, max_side, quality)
+            current[key] = job
+        futures.append(current[key])
+    # Forget files that are no longer in the uploader
+    st.session_state["upload_jobs"] = current
+    return futures
+
+
+def get_images_from_uploads(files, max_side=1600, quality=85):
+    """Convert uploaded files into a list of (hash, image_bytes, media_type) tuples.
+    Images stay as raw bytes; base64 is only produced when a check is
+    actually sent, so cache hits and duplicates never pay for it."""
+    images = []
+    for f, fut in zip(files, submit_uploads(files, max_side, quality)):
+        # A file that can't be converted is reported and skipped, not allowed to sink the whole run
+        try:
+            images.extend(fut.result())
+        except Exception as e:
+            st.error(f"Could not read {f.name}: {e}")
     return images
 
 
-def parse_check(client, img_b64, media_type):
-    """Send a single check image to Claude and get structured data back."""
+def parse_check_batch(client, items):
+    """Send several check images to Claude in one request and get structured data back.
+    items is a list of (base64_data, media_type) tuples; the result has one
+    entry per item, in the same order: the parsed dict, or the exception
+    that made that check unusable. Sharing a request amortizes the
+    extraction prompt and the HTTP round-trip over the whole batch."""
+    content = []
+    for n, (img_b64, media_type) in enumerate(items, 1):
+        content.append({"type": "text", "text": f"Check {n}:"})
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": img_b64,
+            },
+        })
+    content.append({
+        "type": "text",
+        "text": f"{EXTRACTION_PROMPT}\n\nThere are {len(items)} check image(s). Return a JSON array of {len(items)} object(s), in order.",
+    })
     response = client.messages.create(
-        model="claude-sonnet-4-5-20250929",
-        max_tokens=2048,
-        messages=[{
-            "role": "user",
-            "content": [
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": media_type,
-                        "data": img_b64,
-                    },
-                },
-                {"type": "text", "text": EXTRACTION_PROMPT},
-            ],
-        }],
+        model=MODEL,
+        max_tokens=2048 * len(items),
+        messages=[{"role": "user", "content": content}],
     )
-    text = response.content[0].text.strip()
-    # Clean up any markdown fencing
-    if text.startswith("```"):
-        text = text.split("\n", 1)[1]
-        text = text.rsplit("```", 1)[0]
-        text = text.strip()
-    # Find JSON object in response
-    match = re.search(r'\{[^{}]*\}', text, re.DOTALL)
+    # Clean up any markdown fencing (a no-op when there is none)
+    text = _FENCE_RE.sub("", response.content[0].text).strip()
+    # Find JSON array in response, falling back to a single object
+    match = _JSON_ARRAY_RE.search(text) or _JSON_OBJ_RE.search(text)
     if match:
         text = match.group(0)
-    data = json.loads(text)
-    # Ensure Amount is a float
-    if isinstance(data.get("Amount"), str):
-        data["Amount"] = float(data["Amount"].replace(",", "").replace("$", ""))
-    return data
+    data = orjson.loads(text)
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or len(data) != len(items):
+        raise ValueError(f"expected {len(items)} check(s) in the response, got {len(data) if isinstance(data, list) else 0}")
+    # Validate each check on its own so one bad entry doesn't discard the rest
+    results = []
+    for ck in data:
+        try:
+            results.append(_clean_check(ck))
+        except ValueError as e:
+            results.append(e)
+    return results
+
+
+def _clean_check(ck):
+    """Validate one parsed check and make sure its Amount is a finite number.
+    Anything that fails here is never cached or rendered."""
+    if not isinstance(ck, dict):
+        raise ValueError(f"expected a JSON object for the check, got {ck!r}")
+    amount = ck.get("Amount", 0)
+    if isinstance(amount, str):
+        amount = float(amount.replace(",", "").replace("$", ""))
+    # bool is an int subclass, but true/false is not an amount
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not math.isfinite(amount):
+        raise ValueError(f"invalid check Amount: {ck.get('Amount')!r}")
+    ck["Amount"] = amount
+    return ck
+
+
+def parse_checks(client, items):
+    """parse_check_batch, retrying checks one at a time when they fail as part of a batch.
+    Only response-shape and validation problems (ValueError, which includes
+    JSON decode errors) are retried; API and transport errors are copied to
+    every remaining check, since resending would only add load to an API
+    that is already refusing requests.
+    Never raises: returns one parsed dict or exception per item, in order."""
+    try:
+        results = parse_check_batch(client, items)
+    except ValueError as e:
+        results = [e] * len(items)
+    except Exception as e:
+        return [e] * len(items)
+    if len(items) > 1:
+        for i, r in enumerate(results):
+            if isinstance(r, Exception):
+                try:
+                    results[i] = parse_check_batch(client, [items[i]])[0]
+                except ValueError as e:
+                    results[i] = e
+                except Exception as e:
+                    # Give up on the checks still waiting for a retry too
+                    return [e if isinstance(x, Exception) else x for x in results]
+    return results
+
+
+@st.cache_resource
+def _cache_db():
+    """SQLite store of image hash -> parsed check, shared by all sessions and kept across restarts.
+    Returns the connection and the lock that serializes access to it."""
+    conn = sqlite3.connect(CACHE_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS parsed ("
+        "h TEXT, version TEXT, ts REAL, data TEXT, PRIMARY KEY (h, version))"
+    )
+    conn.commit()
+    return conn, threading.Lock()
+
+
+def cache_lookup(hashes):
+    """Return {hash: parsed check} for every hash already in the cache."""
+    conn, lock = _cache_db()
+    hashes = list(hashes)
+    found = {}
+    with lock:
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            rows = conn.execute(
+                f"SELECT h, data FROM parsed WHERE version = ? AND h IN ({','.join('?' * len(chunk))})",
+                [_CACHE_VERSION, *chunk],
+            )
+            for h, data in rows:
+                # Rows written before Amount was validated are treated as misses and re-parsed
+                try:
+                    found[h] = _clean_check(orjson.loads(data))
+                except ValueError:
+                    pass
+    return found
+
+
+def cache_store(results):
+    """Save {hash: parsed check} results to the cache."""
+    conn, lock = _cache_db()
+    now = time.time()
+    with lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO parsed (h, version, ts, data) VALUES (?, ?, ?, ?)",
+            [(h, _CACHE_VERSION, now, orjson.dumps(data)) for h, data in results.items()],
+        )
+
+
+# Register styles, built once and shared by every export
+_HDR_FILL = PatternFill("solid", fgColor="1F4E79")
+_HDR_FONT = Font(bold=True, color="FFFFFF", name="Arial", size=10)
+_ALT_FILL = PatternFill("solid", fgColor="D6E4F0")
+_NO_FILL = PatternFill()
+_BORDER = Border(
+    left=Side("thin"), right=Side("thin"),
+    top=Side("thin"), bottom=Side("thin"),
+)
+_MONEY_FMT = "$#,##0.00"
+_TOTAL_FONT = Font(bold=True, name="Arial", size=10)
+_CENTER = Alignment(horizontal="center")
+_CENTER_VC = Alignment(horizontal="center", vertical="center")
 
 
 def generate_xlsx(checks):
     """Generate a formatted XLSX workbook in memory."""
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Check Register"
+    # Write-only mode streams rows out instead of keeping every cell as an object
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Check Register")
 
     headers = ["#", "Payer", "Date", "Amount", "Bank", "Check Number", "Account #", "Routing #", "Claim #"]
     col_widths = [4, 45, 12, 13, 35, 16, 12, 12, 20]
-    hdr_fill = PatternFill("solid", fgColor="1F4E79")
-    hdr_font = Font(bold=True, color="FFFFFF", name="Arial", size=10)
-    alt_fill = PatternFill("solid", fgColor="D6E4F0")
-    border = Border(
-        left=Side("thin"), right=Side("thin"),
-        top=Side("thin"), bottom=Side("thin"),
-    )
-    money_fmt = "$#,##0.00"
 
-    for col, h in enumerate(headers, 1):
-        c = ws.cell(row=1, column=col, value=h)
-        c.font, c.fill, c.border = hdr_font, hdr_fill, border
-        c.alignment = Alignment(horizontal="center", vertical="center")
+    # Register each style once and refer to it by name, instead of serializing
+    # separate font/fill/border objects on every cell
+    named_styles = [
+        NamedStyle(name="hdr", font=_HDR_FONT, fill=_HDR_FILL, border=_BORDER, alignment=_CENTER_VC),
+        NamedStyle(name="total", font=_TOTAL_FONT),
+        NamedStyle(name="total_money", font=_TOTAL_FONT, border=_BORDER, number_format=_MONEY_FMT),
+    ]
+    for parity, fill in (("odd", _NO_FILL), ("even", _ALT_FILL)):
+        named_styles += [
+            NamedStyle(name=parity, fill=fill, border=_BORDER),
+            NamedStyle(name=f"{parity}_center", fill=fill, border=_BORDER, alignment=_CENTER),
+            NamedStyle(name=f"money_{parity}", fill=fill, border=_BORDER, number_format=_MONEY_FMT),
+        ]
+    for style in named_styles:
+        wb.add_named_style(style)
+    # Style names for a whole row: #, Date and Check Number centered, Amount as money
+    col_styles = {1: "{}_center", 3: "{}_center", 4: "money_{}", 6: "{}_center"}
+    row_styles = {
+        parity: [col_styles.get(col, "{}").format(parity) for col in range(1, len(headers) + 1)]
+        for parity in ("odd", "even")
+    }
+
+    # Sheet layout must be set before the first row is written
+    for i, w in enumerate(col_widths):
+        ws.column_dimensions[openpyxl.utils.get_column_letter(i + 1)].width = w
+    tr = len(checks) + 2
+    ws.auto_filter.ref = f"A1:I{tr - 1}"
+    ws.freeze_panes = "A2"
+
+    def make_cell(value, style):
+        c = WriteOnlyCell(ws, value=value)
+        c.style = style
+        return c
+
+    ws.append([make_cell(h, "hdr") for h in headers])
 
     for i, ck in enumerate(checks, 1):
-        r = i + 1
         vals = [
             i, ck.get("Payer", ""), ck.get("Date", ""), ck.get("Amount", 0),
             ck.get("Bank", ""), ck.get("Check_Number", ""), ck.get("Account", ""),
             ck.get("Routing", ""), ck.get("Claim", ""),
         ]
-        for col, v in enumerate(vals, 1):
-            c = ws.cell(row=r, column=col, value=v)
-            c.border = border
-            if i % 2 == 0:
-                c.fill = alt_fill
-        ws.cell(row=r, column=4).number_format = money_fmt
-        ws.cell(row=r, column=1).alignment = Alignment(horizontal="center")
-        ws.cell(row=r, column=3).alignment = Alignment(horizontal="center")
-        ws.cell(row=r, column=6).alignment = Alignment(horizontal="center")
-
-    tr = len(checks) + 2
-    ws.cell(row=tr, column=3, value="TOTAL").font = Font(bold=True, name="Arial", size=10)
-    t = ws.cell(row=tr, column=4, value=f"=SUM(D2:D{tr - 1})")
-    t.number_format = money_fmt
-    t.font = Font(bold=True, name="Arial", size=10)
-    t.border = border
+        styles = row_styles["even" if i % 2 == 0 else "odd"]
+        ws.append([make_cell(v, style) for v, style in zip(vals, styles)])
 
-    for i, w in enumerate(col_widths):
-        ws.column_dimensions[openpyxl.utils.get_column_letter(i + 1)].width = w
-
-    ws.auto_filter.ref = f"A1:I{tr - 1}"
-    ws.freeze_panes = "A2"
+    ws.append([
+        None, None, make_cell("TOTAL", "total"),
+        make_cell(f"=SUM(D2:D{tr - 1})", "total_money"),
+    ])
 
     buf = io.BytesIO()
     wb.save(buf)
@@ -241,44 +481,90 @@ def generate_xlsx(checks):
     return buf
 
 
-def generate_csv(checks):
-    """Generate a CSV in memory."""
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["#", "Payer", "Date", "Amount", "Bank", "Check Number", "Account #", "Routing #", "Claim #"])
+class _Echo:
+    """File-like object whose write() hands the formatted line straight back."""
+    def write(self, value):
+        return value
+
+
+def iter_csv_rows(checks):
+    """Yield the check register as CSV text, one line at a time."""
+    w = csv.writer(_Echo())
+    yield w.writerow(["#", "Payer", "Date", "Amount", "Bank", "Check Number", "Account #", "Routing #", "Claim #"])
+    total = 0
     for i, ck in enumerate(checks, 1):
-        w.writerow([
+        total += ck.get("Amount", 0)
+        yield w.writerow([
             i, ck.get("Payer", ""), ck.get("Date", ""),
             f'{ck.get("Amount", 0):.2f}', ck.get("Bank", ""),
             ck.get("Check_Number", ""), ck.get("Account", ""),
             ck.get("Routing", ""), ck.get("Claim", ""),
         ])
-    total = sum(c.get("Amount", 0) for c in checks)
-    w.writerow(["", "", "TOTAL", f"{total:.2f}", "", "", "", "", ""])
-    return buf.getvalue()
+    yield w.writerow(["", "", "TOTAL", f"{total:.2f}", "", "", "", "", ""])
+
+
+def generate_csv(checks):
+    """Generate a CSV in memory."""
+    return "".join(iter_csv_rows(checks))
 
 
 # ─── Process ───
+if uploaded_files:
+    # Start converting right away so the work overlaps with the user reviewing settings
+    submit_uploads(uploaded_files, max_side, jpeg_quality)
+
 if uploaded_files and api_key:
     if st.button("Parse Checks", type="primary", use_container_width=True):
         client = anthropic.Anthropic(api_key=api_key)
 
         with st.spinner("Converting files to images..."):
-            images = get_images_from_uploads(uploaded_files)
+            images = get_images_from_uploads(uploaded_files, max_side, jpeg_quality)
 
         st.info(f"Found {len(images)} check(s) to parse.")
 
-        checks = []
-        progress = st.progress(0, text="Parsing checks...")
-
-        for idx, (img_b64, media_type) in enumerate(images):
-            progress.progress(idx / len(images), text=f"Parsing check {idx + 1} of {len(images)}...")
-            try:
-                check_data = parse_check(client, img_b64, media_type)
-                checks.append(check_data)
-            except Exception as e:
-                st.error(f"Error parsing check {idx + 1}: {e}")
+        # Identical images (re-uploads, duplicate scans) share a single API call
+        unique = {}
+        positions = {}
+        for idx, (h, img_bytes, media_type) in enumerate(images):
+            unique.setdefault(h, (img_bytes, media_type))
+            positions.setdefault(h, []).append(idx)
+
+        # Reuse earlier results, then parse the rest in batches of batch_size checks
+        parsed = cache_lookup(unique)
+        pending = [h for h in unique if h not in parsed]
+        # Encode each image that actually goes to the API exactly once; batches and retries reuse it
+        payloads = {
+            h: (base64.standard_b64encode(unique[h][0]).decode("ascii"), unique[h][1])
+            for h in pending
+        }
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
 
+        progress = st.progress(0, text="Parsing checks...")
+        done = sum(len(positions[h]) for h in parsed)
+
+        # API calls are I/O-bound, so run them concurrently and keep results in upload order
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = {
+                ex.submit(parse_checks, client, [payloads[h] for h in batch]): batch
+                for batch in batches
+            }
+            for fut in as_completed(futures):
+                batch = futures[fut]
+                batch_results = {}
+                for h, r in zip(batch, fut.result()):
+                    if isinstance(r, Exception):
+                        nums = ", ".join(str(idx + 1) for idx in positions[h])
+                        st.error(f"Error parsing check {nums}: {r}")
+                    else:
+                        batch_results[h] = r
+                if batch_results:
+                    cache_store(batch_results)
+                    parsed.update(batch_results)
+                done += sum(len(positions[h]) for h in batch)
+                progress.progress(done / len(images), text=f"Parsed {done} of {len(images)} checks...")
+
+        results = [dict(parsed[h]) if h in parsed else None for h, _, _ in images]
+        checks = [r for r in results if r is not None]
         progress.progress(1.0, text="Done!")
 
         if checks: